@@ -4,7 +4,12 @@
 
 import sys
 import os
+import json
+import queue
+import re
+import socket
 import subprocess
+import threading
 import time
 
 from PyQt6.QtWidgets import (
@@ -14,10 +19,13 @@ from PyQt6.QtWidgets import (
     QLabel, QDialog, QFormLayout,
     QSpinBox, QDialogButtonBox
 )
-from PyQt6.QtGui import QAction
+from PyQt6.QtGui import (
+    QAction, QTextCursor, QTextBlockFormat, QTextCharFormat
+)
 from PyQt6.QtCore import (
     Qt, QThread, QRunnable, QThreadPool,
-    QObject, pyqtSignal, pyqtSlot, QSettings
+    QObject, pyqtSignal, pyqtSlot, QSettings,
+    QMutex, QMutexLocker, QTimer
 )
 
 # =====================================================
@@ -39,65 +47,235 @@ def get_bundled_adb():
     return adb_path if os.path.exists(adb_path) else "adb"
 
 
+# Resolved once; the bundle location never changes at runtime
+ADB_PATH = get_bundled_adb()
+
+
+# On Windows, stop every adb spawn from creating a console window
+SPAWN_KWARGS = {}
+if os.name == "nt":
+    _si = subprocess.STARTUPINFO()
+    _si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    _si.wShowWindow = 0  # SW_HIDE
+    SPAWN_KWARGS = {
+        "creationflags": subprocess.CREATE_NO_WINDOW,
+        "startupinfo": _si,
+    }
+
+
+# =====================================================
+# ADB SERVER PROTOCOL
+# =====================================================
+
+ADB_HOST = "127.0.0.1"
+ADB_PORT = 5037
+
+
+def adb_request(service):
+    """
+    Frames a host service request for the ADB server:
+    4 hex digits of length followed by the service string.
+    """
+    return f"{len(service):04x}{service}".encode("ascii")
+
+
+class AdbClient:
+    """
+    Talks to the ADB server on localhost:5037 directly,
+    the same way adb.exe does, so commands need no process spawn.
+    Each connection carries one service; shell() opens a fresh one.
+    """
+
+    def __init__(self, host=ADB_HOST, port=ADB_PORT, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    @staticmethod
+    def read_exact(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("ADB server closed connection")
+            data += chunk
+        return data
+
+    def request(self, sock, service):
+        sock.sendall(adb_request(service))
+        status = self.read_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            size = int(self.read_exact(sock, 4), 16)
+            reason = self.read_exact(sock, size).decode("utf-8", "replace")
+            raise ConnectionError(f"{service}: {reason}")
+        raise ConnectionError(f"{service}: unexpected reply {status!r}")
+
+    def connect(self, serial=None):
+        """Opens a server connection, switched to serial's transport if given."""
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            if serial:
+                self.request(sock, f"host:transport:{serial}")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, serial, cmd, timeout=None):
+        """
+        Runs cmd and returns its output. The client timeout covers the
+        handshake; timeout (None = no limit) is a deadline in seconds
+        for the whole command, however its output trickles in.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.connect(serial) as sock:
+            self.request(sock, f"shell:{cmd}")
+            sock.settimeout(None)
+            chunks = []
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout(f"shell command timed out after {timeout}s")
+                    sock.settimeout(remaining)
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", "replace")
+
+
 # =====================================================
 # SIGNALS
 # =====================================================
 
 class Signals(QObject):
-    log = pyqtSignal(str)
-    device_count = pyqtSignal(int)
+    """
+    Worker -> GUI channel.
+    Log lines and the device count are left in plain Python objects
+    that the GUI log timer drains; only events that need a slot to run
+    go through Qt signals.
+    """
+    done = pyqtSignal(str)
+    provisioned = pyqtSignal(str, str)
+
+    def __init__(self):
+        super().__init__()
+        self.log_q = queue.SimpleQueue()
+        self.count_val = None
+
+    def log(self, text):
+        self.log_q.put((time.strftime("%H:%M:%S"), text))
 
 
 # =====================================================
 # DEVICE WORKER (ALWAYS RUNS COMMANDS)
 # =====================================================
 
+BOOT_WAIT_SECS = 120
+# Each boot poll is short so a stalled device can't pin a worker
+BOOT_POLL_TIMEOUT = 3
+
+# Boot state and boot id in one round trip; boot_id changes on every reboot
+BOOT_QUERY = "getprop sys.boot_completed; cat /proc/sys/kernel/random/boot_id"
+
+# Workers only wait on adb sockets, so they need little stack and
+# should hand their threads back soon after a burst of new devices
+WORKER_STACK_SIZE = 512 * 1024
+WORKER_EXPIRY_MS = 5000
+
+# Deadline for the whole wake + provisioning script; can be slow right after boot
+PROVISION_TIMEOUT = 120
+
+# Printed only if every provisioning command succeeded
+PROVISION_MARKER = "__PROVISIONED__"
+
+#replace ussd with actual ussd you want to run
+# Wake and provisioning commands, sent as one line once boot has completed
+PROVISION_SCRIPT = " && ".join([
+    "input keyevent 82",
+    "pm disable-user --user 0 com.google.android.setupwizard",
+    "am broadcast -a android.provider.Telephony.SECRET_CODE"
+    " -d android_secret_code://ussd",
+    f"echo {PROVISION_MARKER}",
+])
+
+
 class DeviceWorker(QRunnable):
-    def __init__(self, serial, signals):
+    def __init__(self, serial, client, signals, done_cache, cancelled):
         super().__init__()
         self.serial = serial
+        self.client = client
         self.signals = signals
-        self.adb = get_bundled_adb()
+        self.done_cache = done_cache
+        self.cancelled = cancelled
 
     @pyqtSlot()
     def run(self):
-        self.signals.log.emit(f"[+] Processing {self.serial}")
+        try:
+            self.provision()
+        finally:
+            self.signals.done.emit(self.serial)
+
+    def provision(self):
+        if self.cancelled.is_set():
+            return
+        self.signals.log(f"[+] Processing {self.serial}")
 
         # ---- Wait for boot ----
-        try:
-            r = subprocess.run(
-                [self.adb, "-s", self.serial, "shell", "getprop", "sys.boot_completed"],
-                capture_output=True,
-                text=True,
-                timeout=120
-            )
-            if r.stdout.strip() != "1":
-                self.signals.log.emit(f"[!] {self.serial} boot timeout")
+        deadline = time.monotonic() + BOOT_WAIT_SECS
+        while True:
+            try:
+                out = self.client.shell(
+                    self.serial, BOOT_QUERY, timeout=BOOT_POLL_TIMEOUT
+                )
+            except OSError:
+                # Timeouts and "device offline"/closed replies while
+                # adbd restarts during early boot: not booted yet
+                out = ""
+            except Exception as e:
+                self.signals.log(f"[!] Boot check failed: {e}")
                 return
-        except Exception as e:
-            self.signals.log.emit(f"[!] Boot check failed: {e}")
+
+            lines = out.splitlines() + ["", ""]
+            if lines[0].strip() == "1":
+                boot_id = lines[1].strip()
+                break
+            if time.monotonic() >= deadline:
+                self.signals.log(f"[!] {self.serial} boot timeout")
+                return
+            if self.cancelled.wait(1):
+                return
+
+        # ---- Skip if already provisioned since this boot ----
+        key = f"{self.serial}:{boot_id}"
+        if boot_id and self.done_cache.get(self.serial) == key:
+            self.signals.log(f"[=] {self.serial} already provisioned (cached)")
             return
 
-        # ---- Wake device ----
-        subprocess.run(
-            [self.adb, "-s", self.serial, "shell", "input", "keyevent", "82"],
-            capture_output=True
-        )
-        #replace ussd with actual ussd you want to run 
-        # ---- Provisioning commands ----
-        commands = [
-            [self.adb, "-s", self.serial, "shell", "pm", "disable-user",
-             "--user", "0", "com.google.android.setupwizard"],
+        if self.cancelled.is_set():
+            return
 
-            [self.adb, "-s", self.serial, "shell", "am", "broadcast",
-             "-a", "android.provider.Telephony.SECRET_CODE",
-             "-d", "android_secret_code://ussd"]
-        ]
+        # ---- Wake + provisioning ----
+        try:
+            out = self.client.shell(
+                self.serial, PROVISION_SCRIPT, timeout=PROVISION_TIMEOUT
+            )
+        except Exception as e:
+            self.signals.log(f"[!] {self.serial} provisioning failed: {e}")
+            return
 
-        for cmd in commands:
-            subprocess.run(cmd, capture_output=True)
+        # A dropped transport or a failing command also ends the stream
+        # normally; only the marker proves the script ran to the end
+        if PROVISION_MARKER not in out.split():
+            self.signals.log(f"[!] {self.serial} provisioning failed: script incomplete")
+            return
 
-        self.signals.log.emit(f"[✓] Done {self.serial}")
+        if boot_id:
+            self.signals.provisioned.emit(self.serial, key)
+        self.signals.log(f"[✓] Done {self.serial}")
 
 
 # =====================================================
@@ -105,52 +283,162 @@ class DeviceWorker(QRunnable):
 # =====================================================
 
 class MonitorThread(QThread):
-    def __init__(self, max_devices, signals):
+    """
+    Keeps one connection to the ADB server open with host:track-devices.
+    The server pushes the full device list whenever it changes, so only
+    newly appeared serials are handed to a DeviceWorker.
+    """
+
+    def __init__(self, max_devices, threadpool, in_flight, lock,
+                 signals, done_cache):
         super().__init__()
-        self.adb = get_bundled_adb()
+        self.adb = ADB_PATH
+        self.client = AdbClient()
         self.max_devices = max_devices
         self.signals = signals
+        self.done_cache = done_cache
         self.running = False
+        self.known = set()
+        self.last_payload = None
+        self.sock = None
+
+        # Set by stop(); cuts retry waits short and cancels workers
+        self.stopping = threading.Event()
+
+        # Owned by MainWindow and shared across start/stop, so a worker
+        # left over from the previous run still blocks its serial
+        self.threadpool = threadpool
+        self.in_flight = in_flight
+        self.lock = lock
+        # Connected serials that showed up while a worker still held them;
+        # redispatch() starts them once that worker is done
+        self.pending = set()
+
+    def open_tracker(self):
+        # adb.exe is only needed to make sure the server is up
+        subprocess.run([self.adb, "start-server"], capture_output=True, **SPAWN_KWARGS)
+
+        sock = self.client.connect()
+        try:
+            self.client.request(sock, "host:track-devices")
+        except Exception:
+            sock.close()
+            raise
+
+        # Short timeout so stop() is noticed while waiting for updates
+        sock.settimeout(0.5)
+        return sock
+
+    def handle_devices(self, payload):
+        # The server resends the full list on every reconnect;
+        # an identical list needs no work
+        if payload == self.last_payload:
+            return
+        self.last_payload = payload
+
+        # Stay in bytes; only the serial itself gets decoded
+        devices = set()
+        for line in payload.splitlines():
+            if line.endswith(b"\tdevice"):
+                devices.add(line.split(b"\t", 1)[0].decode("ascii", "replace"))
+
+        self.signals.count_val = len(devices)
+
+        # Only bookkeeping happens under the lock;
+        # submitting to the pool is done after it is released
+        workers = []
+        with QMutexLocker(self.lock):
+            self.pending &= devices
+            for serial in devices - self.known:
+                if serial in self.in_flight:
+                    self.pending.add(serial)
+                    continue
+                self.in_flight.add(serial)
+                workers.append(self.make_worker(serial))
+
+        for worker in workers:
+            self.threadpool.start(worker)
+
+        self.known = devices
+
+    def make_worker(self, serial):
+        return DeviceWorker(
+            serial, self.client, self.signals,
+            self.done_cache, self.stopping
+        )
 
-        self.threadpool = QThreadPool()
-        self.threadpool.setMaxThreadCount(max_devices)
+    def redispatch(self, serial):
+        """
+        Called once serial has left in_flight. track-devices won't push
+        again for a device that stayed connected, so a pending serial
+        is started here instead.
+        """
+        with QMutexLocker(self.lock):
+            if not self.running or serial not in self.pending:
+                return
+            self.pending.discard(serial)
+            self.in_flight.add(serial)
+            worker = self.make_worker(serial)
+
+        self.threadpool.start(worker)
 
     def run(self):
         self.running = True
-        self.signals.log.emit(f"Monitoring started (max {self.max_devices} devices)")
+        self.signals.log(f"Monitoring started (max {self.max_devices} devices)")
 
         while self.running:
             try:
-                r = subprocess.run(
-                    [self.adb, "devices"],
-                    capture_output=True,
-                    text=True
-                )
-
-                devices = []
-                for line in r.stdout.splitlines()[1:]:
-                    if line.strip().endswith("\tdevice"):
-                        devices.append(line.split("\t")[0])
-
-                self.signals.device_count.emit(len(devices))
-
-                for serial in devices:
-                    worker = DeviceWorker(serial, self.signals)
-                    self.threadpool.start(worker)
+                sock = self.sock = self.open_tracker()
+            except Exception as e:
+                self.signals.log(f"[!] ADB server error: {e}")
+                self.stopping.wait(1.0)
+                continue
 
-                self.msleep(2000)
+            buf = b""
+            try:
+                while self.running:
+                    try:
+                        chunk = sock.recv(4096)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        raise ConnectionError("ADB server closed connection")
+                    buf += chunk
+
+                    # Each update is <4 hex length><device list>
+                    while len(buf) >= 4:
+                        size = int(buf[:4], 16)
+                        if len(buf) < 4 + size:
+                            break
+                        self.handle_devices(buf[4:4 + size])
+                        buf = buf[4 + size:]
 
             except Exception as e:
-                self.signals.log.emit(f"[!] Poll error: {e}")
-                self.msleep(1000)
+                if self.running:
+                    self.signals.log(f"[!] Poll error: {e}")
+                    self.stopping.wait(1.0)
+            finally:
+                self.sock = None
+                sock.close()
 
     def stop(self):
         self.running = False
-        self.threadpool.clear()
-        self.threadpool.waitForDone(3000)
+        self.stopping.set()
+
+        # Unblock a recv() waiting on the tracker connection
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
         self.quit()
         self.wait(5000)
 
+        # Queued workers are left to run: they see stopping and return
+        # straight away, emitting done so their serial leaves in_flight
+        self.threadpool.waitForDone(3000)
+
 
 # =====================================================
 # SETTINGS DIALOG (ONLY MAX DEVICES)
@@ -184,24 +472,66 @@ class SettingsDialog(QDialog):
 # MAIN WINDOW
 # =====================================================
 
+LOG_FLUSH_MS = 50
+SETTINGS_SAVE_MS = 500
+# Oldest entries are dropped past this many remembered serials
+DONE_CACHE_MAX = 500
+
+
 class MainWindow(QMainWindow):
+    ERR_RE = re.compile(r"!|error|failed|timeout", re.IGNORECASE)
+    ERR_TPL = "[{ts}] <span style='color:#ff4444;font-weight:bold'>{text}</span>"
+    OK_TPL = "[{ts}] <span style='color:#44ff44'>{text}</span>"
+
     def __init__(self):
         super().__init__()
 
         self.settings = QSettings("MyCompany", "ADB_AutoProvision")
         self.max_devices = int(self.settings.value("max_devices", 6))
 
+        # serial -> "serial:boot_id" of the last successful provisioning
+        try:
+            self.done_cache = json.loads(self.settings.value("done_cache", "{}"))
+        except (TypeError, ValueError):
+            self.done_cache = {}
+        if not isinstance(self.done_cache, dict):
+            self.done_cache = {}
+
+        # Settings writes are collected and flushed together
+        self.pending_settings = {}
+        self.save_timer = QTimer(self)
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(SETTINGS_SAVE_MS)
+        self.save_timer.timeout.connect(self.persist_settings)
+
         self.monitor_thread = None
 
+        # One worker pool for the lifetime of the window
+        self.threadpool = QThreadPool()
+        self.threadpool.setMaxThreadCount(self.max_devices)
+        self.threadpool.setStackSize(WORKER_STACK_SIZE)
+        self.threadpool.setExpiryTimeout(WORKER_EXPIRY_MS)
+
+        # Serials with a DeviceWorker queued or running, across runs
+        self.in_flight = set()
+        self.in_flight_lock = QMutex()
+
         self.setWindowTitle("ADB Auto-Provision v2.3")
         self.setGeometry(100, 100, 900, 700)
 
         self.create_menu_bar()
         self.build_ui()
 
+        # Log lines and the device count are picked up in batches
+        self.shown_count = 0
+        self.log_timer = QTimer(self)
+        self.log_timer.setInterval(LOG_FLUSH_MS)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start()
+
         self.signals = Signals()
-        self.signals.log.connect(self.append_log)
-        self.signals.device_count.connect(self.update_device_count)
+        self.signals.provisioned.connect(self.on_provisioned)
+        self.signals.done.connect(self.on_worker_done)
 
     # ---------------- UI ----------------
     def build_ui(self):
@@ -233,6 +563,9 @@ class MainWindow(QMainWindow):
         self.log_edit = QPlainTextEdit()
         self.log_edit.setReadOnly(True)
         self.log_edit.setMaximumBlockCount(1000)
+        # Read-only log: no undo history to grow with every append
+        self.log_edit.setUndoRedoEnabled(False)
+        self.log_edit.setCenterOnScroll(False)
 
         layout.addWidget(self.log_edit)
         widget.setLayout(layout)
@@ -266,25 +599,86 @@ class MainWindow(QMainWindow):
         dialog = SettingsDialog(self.max_devices, self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
             self.max_devices = dialog.max_spin.value()
-            self.settings.setValue("max_devices", self.max_devices)
+            self.mark_dirty("max_devices", self.max_devices)
+            self.threadpool.setMaxThreadCount(self.max_devices)
             self.append_log(f"Settings saved: Max Devices = {self.max_devices}")
 
+    def mark_dirty(self, key, value):
+        self.pending_settings[key] = value
+        self.save_timer.start()
+
+    def persist_settings(self):
+        for key, value in self.pending_settings.items():
+            if isinstance(value, dict):
+                value = json.dumps(value)
+            self.settings.setValue(key, value)
+        self.pending_settings.clear()
+
     def show_about(self):
         self.append_log("ADB Auto-Provisioner v2.3 — Embedded ADB")
 
     # ---------------- LOGGING ----------------
     def append_log(self, text):
-        ts = time.strftime("%H:%M:%S")
-        if any(k in text.lower() for k in ["!", "error", "failed", "timeout"]):
-            html = f"[{ts}] <span style='color:#ff4444;font-weight:bold'>{text}</span>"
-        else:
-            html = f"[{ts}] <span style='color:#44ff44'>{text}</span>"
+        self.signals.log(text)
 
-        self.log_edit.appendHtml(html)
+    def flush_log(self):
+        count = self.signals.count_val
+        if count is not None and count != self.shown_count:
+            self.update_device_count(count)
+
+        lines = []
+        try:
+            while True:
+                ts, text = self.signals.log_q.get_nowait()
+                tpl = self.ERR_TPL if self.ERR_RE.search(text) else self.OK_TPL
+                lines.append(tpl.format(ts=ts, text=text))
+        except queue.Empty:
+            pass
+        if not lines:
+            return
+
+        # Only follow the tail if the user hasn't scrolled up
         sb = self.log_edit.verticalScrollBar()
-        sb.setValue(sb.maximum())
+        at_bottom = sb.value() == sb.maximum()
+
+        # One edit block with painting off: a single relayout and repaint
+        # per flush. Each line still gets its own block so the
+        # maximum block count keeps trimming by line.
+        doc = self.log_edit.document()
+        cur = QTextCursor(doc)
+        cur.movePosition(QTextCursor.MoveOperation.End)
+
+        self.log_edit.setUpdatesEnabled(False)
+        cur.beginEditBlock()
+        for html in lines:
+            if not doc.isEmpty():
+                cur.insertBlock(QTextBlockFormat(), QTextCharFormat())
+            cur.insertHtml(html)
+        cur.endEditBlock()
+        self.log_edit.setUpdatesEnabled(True)
+
+        if at_bottom:
+            sb.setValue(sb.maximum())
+
+    def on_worker_done(self, serial):
+        with QMutexLocker(self.in_flight_lock):
+            self.in_flight.discard(serial)
+
+        if self.monitor_thread:
+            self.monitor_thread.redispatch(serial)
+
+    def on_provisioned(self, serial, key):
+        # Re-insert so the dict stays ordered oldest -> newest
+        self.done_cache.pop(serial, None)
+        self.done_cache[serial] = key
+        while len(self.done_cache) > DONE_CACHE_MAX:
+            del self.done_cache[next(iter(self.done_cache))]
+
+        # Serialized once per save in persist_settings
+        self.mark_dirty("done_cache", self.done_cache)
 
     def update_device_count(self, count):
+        self.shown_count = count
         self.device_label.setText(f"Devices: {count}")
 
     # ---------------- CONTROL ----------------
@@ -292,7 +686,11 @@ class MainWindow(QMainWindow):
         if self.monitor_thread and self.monitor_thread.isRunning():
             return
 
-        self.monitor_thread = MonitorThread(self.max_devices, self.signals)
+        self.monitor_thread = MonitorThread(
+            self.max_devices, self.threadpool,
+            self.in_flight, self.in_flight_lock,
+            self.signals, self.done_cache
+        )
         self.monitor_thread.start()
 
         self.start_btn.setEnabled(False)
@@ -312,6 +710,16 @@ class MainWindow(QMainWindow):
 
         self.append_log("Provisioning stopped")
 
+    def closeEvent(self, event):
+        # Let the monitor thread and its workers exit before the window goes
+        if self.monitor_thread:
+            self.stop_monitoring()
+
+        # Don't lose a save that is still waiting on the debounce timer
+        self.save_timer.stop()
+        self.persist_settings()
+        super().closeEvent(event)
+
 
 # =====================================================
 # ENTRY POINT